@@ -2,10 +2,15 @@
 '''
 Helper script to loop through all entries of the provided json file
 and attempt to download the file provided from key 'pandora_url'.
+Files can optionally be stored compressed (gz, xz or zst), which is
+understood by pandora_cf_sfcno2.py.
 '''
 import os
 import argparse
 import json
+import shutil
+import gzip
+import lzma
 import urllib.request
 
 def main(args):
@@ -15,10 +20,12 @@ def main(args):
         if url is None:
             continue
         ofile = url.split('/')[-1]
+        if args.compress != '':
+            ofile = ofile+'.'+args.compress
         if not os.path.isfile(ofile):
             print('attempting to download {}'.format(url))
             try:
-                urllib.request.urlretrieve(url,ofile)
+                _download(url,ofile,args.compress)
             except:
                 print('could not download {}'.format(ofile))
         else:
@@ -26,9 +33,41 @@ def main(args):
     return
 
 
+def _download(url,ofile,compress=''):
+    '''
+    Download url to ofile, compressing the stream on the fly if compress is
+    one of gz, xz or zst. Data is written to a temporary file first so that
+    failed downloads do not leave partial files behind.
+    '''
+    tmpfile = ofile+'.part'
+    try:
+        with urllib.request.urlopen(url) as src, _open_output(tmpfile,compress) as dst:
+            shutil.copyfileobj(src,dst,1024*1024)
+        os.replace(tmpfile,ofile)
+    finally:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+    return
+
+
+def _open_output(ofile,compress=''):
+    '''
+    Open ofile for binary writing with the given compression.
+    '''
+    if compress == 'gz':
+        return gzip.open(ofile,'wb')
+    if compress == 'xz':
+        return lzma.open(ofile,'wb')
+    if compress == 'zst':
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(open(ofile,'wb'),closefd=True)
+    return open(ofile,'wb')
+
+
 def parse_args():
     p = argparse.ArgumentParser(description='Undef certain variables')
     p.add_argument('-l', '--urllist',type=str,help='url list',default="PANDORA_Locations.json")
+    p.add_argument('-z', '--compress',type=str,help='store compressed (gz, xz or zst)',default='',choices=['','gz','xz','zst'])
     return p.parse_args()
 
  
@@ -0,0 +1,179 @@
+#!/usr/local/other/python/GEOSpyD/2019.03_py3.7/2019-04-22/bin/python
+'''
+Helper script to extract the GEOS-CF columns needed by pandora_cf_sfcno2.py
+(NO2, T, DELP, ZL, Q, PS and ZPBL) at all sites of the provided json file
+into one NetCDF file per site location (column store). Each GEOS-CF file is
+read only once for all sites. The store files have an unlimited time
+dimension, so that subsequent runs only extract and append the hours after
+the last hour already stored. The store is used by pandora_cf_sfcno2.py if
+option --cf_store is set (with the same locations file), which avoids
+reading the global GEOS-CF files when re-matching Pandora observations.
+
+EXAMPLES:
+python extract_cf_sites.py -o cf_store -m 2020-01-01
+python pandora_cf_sfcno2.py -n -1 --cf_store cf_store
+'''
+import os
+import argparse
+import json
+import threading
+import numpy as np
+import pandas as pd
+import datetime as dt
+import netCDF4 as nc
+import pandora_cf_sfcno2 as pcf
+
+# time units of the store files
+STORE_TIME_UNITS = "hours since 2000-01-01 00:00:00"
+# number of hours per chunk of the store files
+STORE_CHUNK = 720
+
+def main(args):
+    # one store file per site location, shared by all instruments at the site.
+    # Entries without site name or coordinates are skipped
+    locations = []
+    ofiles = []
+    for l in json.load(open(args.locations)):
+        ofile = pcf._cf_store_file(args.store_dir,l)
+        if ofile is None:
+            print('Warning - no site name or coordinates, skip: {}'.format(l.get('pandora_url')))
+        elif ofile not in ofiles:
+            locations.append(l)
+            ofiles.append(ofile)
+    locs = [(l['latitude'],l['longitude']) for l in locations]
+    os.makedirs(args.store_dir,exist_ok=True)
+    # extract until three days from now (due to CF latency)
+    maxdate = dt.datetime.today() - dt.timedelta(days=3)
+    maxdate = dt.datetime(maxdate.year,maxdate.month,maxdate.day)
+    if args.enddate != '':
+        maxdate = dt.datetime.strptime(args.enddate,"%Y-%m-%d")
+    mindate = dt.datetime.strptime(args.mindate,"%Y-%m-%d")
+    # first hour to extract for each site: after the last hour already stored
+    starts = [_next_hour(ofile,mindate) for ofile in ofiles]
+    hours = pd.date_range(min(starts),maxdate,freq='h')
+    if len(hours)==0:
+        print('column store is up to date')
+        return
+
+    # hours with GEOS-CF files available, per collection
+    index = pcf.CFFileIndex(args.cf_index)
+    files = {}
+    for hour in hours:
+        templ = hour.strftime(args.cf_template)
+        files[hour] = {c:templ.replace('<col>',c) for c in ['chm','met']}
+        files[hour]['pbl'] = hour.strftime(args.pbl_template)
+        files[hour] = {c:ifile for c,ifile in files[hour].items() if index.isfile(ifile)}
+    index.save()
+    hours = [hour for hour in hours if len(files[hour])>0]
+    print('extracting {} hours for {} sites'.format(len(hours),len(locations)))
+
+    dsets = pcf.DatasetCache(args.max_open_files)
+    # the HDF5 library is not thread-safe: reading GEOS-CF files in the prefetch
+    # thread must not overlap with writing the store files
+    lock = threading.Lock()
+    def readfunc(hour):
+        with lock:
+            return {c:pcf._read_cf_columns(dsets.get(c,ifile),pcf.CF_VARIABLES[c],locs) for c,ifile in files[hour].items()}
+    buffers = [[] for l in locations]
+    for n,(hour,cols) in enumerate(pcf._prefetch(hours,readfunc,args.prefetch)):
+        for i in range(len(locations)):
+            if hour >= starts[i]:
+                buffers[i].append((hour,{c:cols[c][i] for c in cols}))
+        # write in batches of hours
+        if (n+1)%args.batch==0 or n==len(hours)-1:
+            with lock:
+                for iloc,ofile,buf in zip(locations,ofiles,buffers):
+                    _append_store(ofile,iloc,buf)
+            buffers = [[] for l in locations]
+    print(dsets.stats())
+    dsets.close()
+    return
+
+
+def _next_hour(ofile,mindate):
+    '''
+    Return the first hour to extract for store file ofile, i.e. the hour after
+    the last hour stored, or mindate if the file does not exist yet.
+    '''
+    if not os.path.isfile(ofile):
+        return pd.Timestamp(mindate)
+    with nc.Dataset(ofile,'r') as f:
+        if len(f.dimensions['time'])==0:
+            return pd.Timestamp(mindate)
+        last = nc.num2date(f['time'][-1],f['time'].units,only_use_cftime_datetimes=False)
+    return max(pd.Timestamp(last)+pd.Timedelta(hours=1),pd.Timestamp(mindate))
+
+
+def _append_store(ofile,iloc,buf):
+    '''
+    Append the GEOS-CF columns in buf, a list of (hour, columns by collection),
+    to the store file ofile of location iloc. Variables of collections missing
+    in an hour are stored as NaN. The file is created if it does not exist.
+    '''
+    if len(buf)==0:
+        return
+    if not os.path.isfile(ofile):
+        nlev = [len(cols['met']['T']) for hour,cols in buf if 'met' in cols]
+        if len(nlev)==0:
+            return
+        _create_store(ofile,iloc,nlev[0])
+    with nc.Dataset(ofile,'a') as f:
+        n = len(f.dimensions['time'])
+        times = [hour.to_pydatetime() for hour,cols in buf]
+        f['time'][n:n+len(buf)] = nc.date2num(times,STORE_TIME_UNITS)
+        for c,varnames in pcf.CF_VARIABLES.items():
+            for v in varnames:
+                shape = f[v].shape[1:]
+                arr = np.full((len(buf),)+shape,np.nan,dtype=np.float32)
+                for j,(hour,cols) in enumerate(buf):
+                    if c in cols:
+                        arr[j] = cols[c][v]
+                f[v][n:n+len(buf)] = arr
+    print('{} hours appended to {}'.format(len(buf),ofile))
+    return
+
+
+def _create_store(ofile,iloc,nlev):
+    '''
+    Create an empty store file ofile for location iloc with nlev levels.
+    Profiles are stored in the GEOS-CF level order (surface last).
+    '''
+    tmpfile = '{}.{}.tmp'.format(ofile,os.getpid())
+    with nc.Dataset(tmpfile,'w',format='NETCDF4') as f:
+        f.createDimension('time',None)
+        f.createDimension('lev',nlev)
+        t = f.createVariable('time','i4',('time',),chunksizes=(STORE_CHUNK,))
+        t.units = STORE_TIME_UNITS
+        for c,varnames in pcf.CF_VARIABLES.items():
+            for v in varnames:
+                if v in ['PS','ZPBL']:
+                    f.createVariable(v,'f4',('time',),zlib=True,chunksizes=(STORE_CHUNK,),fill_value=np.float32(np.nan))
+                else:
+                    f.createVariable(v,'f4',('time','lev'),zlib=True,chunksizes=(STORE_CHUNK,nlev),fill_value=np.float32(np.nan))
+                f[v].collection = c
+        f['ZPBL'].comment = 'time average of the hour starting at time'
+        f.site_name = iloc['site_name']
+        f.latitude = iloc['latitude']
+        f.longitude = iloc['longitude']
+    os.replace(tmpfile,ofile)
+    return
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Undef certain variables')
+    p.add_argument('-l', '--locations',type=str,help='locations',default="PANDORA_Locations.json")
+    p.add_argument('-o', '--store_dir',type=str,help='column store directory',default="cf_store")
+    p.add_argument('-c', '--cf_template',type=str,help='GEOS-CF file template',default="/discover/nobackup/projects/gmao/geos_cf/pub/GEOS-CF_NRT/ana/Y%Y/M%m/D%d/GEOS-CF.v01.rpl.<col>_inst_1hr_g1440x721_v72.%Y%m%d_%H00z.nc4")
+    p.add_argument('-p', '--pbl_template',type=str,help='GEOS-CF pbl file template',default="/discover/nobackup/projects/gmao/geos_cf/pub/GEOS-CF_NRT/ana/Y%Y/M%m/D%d/GEOS-CF.v01.rpl.met_tavg_1hr_g1440x721_x1.%Y%m%d_%H30z.nc4")
+    p.add_argument('-m', '--mindate',type=str,help='minimum date (%Y-%m-%d)',default="2020-01-01")
+    p.add_argument('-e', '--enddate',type=str,help='end date (%Y-%m-%d), default is three days ago',default="")
+    p.add_argument('-b', '--batch',type=int,help='number of hours written at once',default=168)
+    p.add_argument('--cf_index',type=str,help='file to store the index of available GEOS-CF files, empty to disable',default="GEOS-CF_index.json")
+    p.add_argument('--prefetch',type=int,help='number of GEOS-CF hours read ahead in the background, 0 to disable',default=2)
+    p.add_argument('--max_open_files',type=int,help='maximum number of GEOS-CF files kept open',default=8)
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
+#
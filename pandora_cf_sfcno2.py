@@ -12,14 +12,21 @@ surface mixing ratios and concentrations is done using environmental quantities
 obtained from GEOS-CF.
 
 EXAMPLES:
-wget https://data.pandonia-global-network.org/WashingtonDC/Pandora140s1/L2/Pandora140s1_WashingtonDC_L2_rnvh3p1-8.txt
-python pandora_cf_sfcno2.py -i Pandora140s1_WashingtonDC_L2_rnvh3p1-8.txt
+wget -P obs https://data.pandonia-global-network.org/WashingtonDC/Pandora140s1/L2/Pandora140s1_WashingtonDC_L2_rnvh3p1-8.txt
+python pandora_cf_sfcno2.py -n 136
 
 HISTORY: 
 20240205 - christoph.a.keller@nasa.gov - initial version
 '''
 import numpy as np
 import os
+import io
+import mmap
+import re
+import glob
+import hashlib
+import gzip
+import lzma
 import pandas as pd
 import datetime as dt
 import matplotlib.pyplot as plt
@@ -27,92 +34,125 @@ import matplotlib.dates as mdates
 import xarray as xr
 import argparse
 import json
+import collections
+import concurrent.futures
+import contextlib
+import sqlite3
 
 VV_TO_MOLEC = 1000./(9.80665*28.9644)
+PANDORA_DATE_FORMAT = "%Y%m%dT%H%M%S.%fz"
+PANDORA_KEY_FORMAT = "%Y%m%dT%H%M%S"
+# Pandora columns known to this script, identified by the (case-insensitive)
+# start of their description in the file header. Columns other than the
+# default ones are only read if requested (--extra_columns). Any column can
+# also be requested as pandora_col<N>, with N as in the header 'Column N'.
+PANDORA_COLUMNS = {
+    "pandora_no2_qval":    "L2 data quality flag for nitrogen dioxide",
+    "pandora_no2_sfcconc": "Nitrogen dioxide surface concentration",
+    "pandora_no2_l1hgt":   "Nitrogen dioxide layer 1 height",
+    "pandora_no2_l1col":   "Nitrogen dioxide layer 1 amount",
+    "pandora_no2_sfcconc_unc": "Independent uncertainty of nitrogen dioxide surface concentration",
+    "pandora_no2_l1col_unc":   "Independent uncertainty of nitrogen dioxide layer 1 amount",
+    "pandora_no2_tropcol":     "Nitrogen dioxide tropospheric vertical column amount",
+    "pandora_no2_tropcol_unc": "Independent uncertainty of nitrogen dioxide tropospheric vertical column amount",
+    "pandora_no2_totcol":      "Nitrogen dioxide total vertical column amount",
+    "pandora_no2_totcol_unc":  "Independent uncertainty of nitrogen dioxide total vertical column amount",
+    }
+PANDORA_DEFAULT_COLUMNS = ["pandora_no2_qval","pandora_no2_sfcconc","pandora_no2_l1hgt","pandora_no2_l1col"]
+# 0-based column indices of known processing versions, used if a column
+# cannot be identified from the header descriptions
+PANDORA_LAYOUTS = {
+    "rnvh3p1-8": {"pandora_no2_qval":52, "pandora_no2_sfcconc":55, "pandora_no2_l1hgt":67, "pandora_no2_l1col":68},
+    }
+# accepted Pandora quality flags: 0/1/2 are assured high/medium/low quality,
+# 10/11/12 not-assured high/medium/low quality
+PANDORA_QVAL_CLASSES = {
+    "all":    None,
+    "high":   [0,10],
+    "medium": [0,1,10,11],
+    }
+# supported compression formats of Pandora files
+PANDORA_COMPRESSION = ['.gz','.xz','.zst']
+# number of lines parsed at once
+PANDORA_CHUNKSIZE = 500000
+# column layouts resolved so far, by processing version
+_LAYOUT_CACHE = {}
+# GEOS-CF quantities added to the observations
+CF_FIELDS = ["pandora_no2_sfcmr","cf_no2_sfcmr","cf_no2_sfcconc","cf_no2_l1col","cf_no2_pbl"]
+# GEOS-CF variables needed, by collection
+CF_VARIABLES = {
+    "chm": ["NO2"],
+    "met": ["PS","T","DELP","ZL","Q"],
+    "pbl": ["ZPBL"],
+    }
+# GEOS-CF grid indices of the sites, by grid definition and location
+_GRID_INDEX_CACHE = {}
 #MINDATE=dt.datetime(2020,1,1)
 
 # read pandora 
 def main(args):
     '''
-    Read Pandora observations and calculate corresponding GEOS-CF quantities
+    Read Pandora observations and calculate corresponding GEOS-CF quantities.
+    If nsite is negative, all sites in the locations file are processed at once
+    so that each GEOS-CF file is read only once for all sites.
     '''
     locations = json.load(open(args.locations))
     assert args.nsite<len(locations),"index out of range: {} vs {}".format(args.nsite,len(locations)) 
-    iloc = locations[args.nsite]
-    basename = iloc.get('pandora_url').split('/')[-1]
-    ifile = "obs/"+basename
-    if not os.path.isfile(ifile):
-        print("obs file does not exist, skip: {}".format(ifile))
-        return
+    ilocs = locations if args.nsite<0 else [locations[args.nsite]]
 
-    ofile = "merged_csv/"+basename.replace(".txt","+GEOSCF.csv")
-    if os.path.isfile(ofile) and args.skip==1:
-        print("file exists, don't do anything: {}".format(ofile))
-        return
-
-    pand,lat,lon = _read_pandora(ifile)
-    # qc flags?
-    ##pand = pand.loc[pand['qval']==10,].copy()
     # limit data to minimum date and three days from now (due to CF latency)
     maxdate = dt.datetime.today() - dt.timedelta(days=3) 
     maxdate = dt.datetime(maxdate.year,maxdate.month,maxdate.day)
     mindate = dt.datetime.strptime(args.mindate,"%Y-%m-%d")
-    pand = pand.loc[pand['date']>=mindate,].copy()
-    pand = pand.loc[pand['date']<=maxdate,].copy()
-    pand = pand.loc[(pand['pandora_no2_l1hgt']>0.0)&(pand['pandora_no2_l1hgt']<15.),].copy()
- 
-    # create empty entries for CF fields 
-    pand['pandora_no2_sfcmr'] = [np.nan for i in range(pand.shape[0])]
-    pand['cf_no2_sfcmr'] = [np.nan for i in range(pand.shape[0])]
-    pand['cf_no2_sfcconc'] = [np.nan for i in range(pand.shape[0])]
-    pand['cf_no2_l1col'] = [np.nan for i in range(pand.shape[0])]
-    pand['cf_no2_pbl'] = [np.nan for i in range(pand.shape[0])]
-
-    # add latitude and longitude to file
-    pand['lat'] = [lat for i in range(pand.shape[0])]
-    pand['lon'] = [lon for i in range(pand.shape[0])]
-
-    pand['year'] = [i.year for i in pand['date']]
+    sites = [_read_site(args,iloc,mindate,maxdate) for iloc in ilocs]
+    sites = [isite for isite in sites if isite is not None]
+    if len(sites)==0:
+        return
 
-    # process year by year
-    years = pand['year'].unique()
+    # process year by year. Open GEOS-CF files and the index of available
+    # GEOS-CF files are shared across years and sites
+    dsets = DatasetCache(args.max_open_files)
+    index = CFFileIndex(args.cf_index)
+    stage = StagingCache(args.stage_dir,args.stage_max_mb,args.stage_window)
+    if args.mf_hours>0 and args.stage_dir is not None:
+        print('Warning - staging cache is not used when reading multi-file datasets (--mf_hours)')
+    # GEOS-CF columns from the column store instead of the GEOS-CF files,
+    # read only for the time range of the observations of each site
+    stores = None
+    if args.cf_store is not None:
+        stores = [_read_cf_store(_cf_store_file(args.cf_store,isite['meta']),isite['lat'],isite['lon'],
+                                 isite['pand']['date'].min(),isite['pand']['date'].max())
+                  if isite['pand'].shape[0]>0 else None for isite in sites]
+    # the years completed for each site are recorded in a checkpoint journal,
+    # so that an interrupted run can be resumed (see _read_site)
+    for isite in sites:
+        _write_journal(isite['journal'],isite['done'])
+    years = sorted(set([y for isite in sites for y in isite['pand']['year'].unique()]))
     for y in years:
-        ipand = pand.loc[pand['year']==y,].copy().drop(columns='year')
+        ipands = [isite['pand'].loc[isite['pand']['year']==y,].copy().drop(columns='year') for isite in sites]
         # populate CF fields
-        fnl={}; dsl={}
-        for irow, row in enumerate(ipand.itertuples()):
-            # get cf values for this entry
-            sfcmr,sfcconc,l1col,pbl,sfcmr_pandora,fnl,dsl = _match_cf(args,row,lat,lon,fnl,dsl)
-            # add to pandas array
-            ipand['pandora_no2_sfcmr'].values[irow] = sfcmr_pandora
-            ipand['cf_no2_sfcmr'].values[irow] = sfcmr
-            ipand['cf_no2_sfcconc'].values[irow] = sfcconc
-            ipand['cf_no2_l1col'].values[irow] = l1col
-            ipand['cf_no2_pbl'].values[irow] = pbl
-
+        _match_cf(args,ipands,[(isite['lat'],isite['lon']) for isite in sites],dsets,index,stage,stores)
         # write to file
-        hasfile = os.path.isfile(ofile)
-        # write new if file does not exist
-        if not hasfile:
-            wm  = 'w+'
-            hdr = True
-        else:
-            # append to existing file
-            if args.append==1:
-                wm  = 'a'
-                hdr = False 
-            # overwrite old file
-            else:
-                wm  = 'w+'
-                hdr = True
-        # if appending, make sure order is correct. 
-        if wm=='a':
-            file_hdr = pd.read_csv(ofile,nrows=1)
-            ipand = ipand[file_hdr.keys()]
-        # now write to csv
-        ipand.to_csv(ofile,index=False,date_format="%Y-%m-%d %H:%M",mode=wm,header=hdr)  # float_format='%.4f'
-        print("data written to {}".format(ofile))
-    
+        for isite,ipand in zip(sites,ipands):
+            if ipand.shape[0]>0:
+                _write_site(args,isite['ofile'],ipand)
+            isite['done']['years'].append(int(y))
+            isite['done']['size'] = _output_size(args,isite['ofile'])
+            _write_journal(isite['journal'],isite['done'])
+    for isite in sites:
+        os.remove(isite['journal'])
+    # site metadata of the consolidated parquet or sqlite output
+    for isite in sites:
+        if args.format=='parquet':
+            _write_site_metadata(isite['ofile'],isite['meta'],isite['lat'],isite['lon'])
+        if args.format=='sqlite':
+            _write_site_sqlite_metadata(args.db_file,isite['ofile'],isite['meta'],isite['lat'],isite['lon'])
+    print(dsets.stats())
+    dsets.close()
+    index.save()
+    stage.close()
+
+    pand = sites[0]['pand']
     # plot l1 columns
     if False:
         plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
@@ -144,135 +184,1472 @@ def main(args):
     return    
    
  
-def _match_cf(args,row,lat,lon,fnl,dsl):
+def _read_site(args,iloc,mindate,maxdate):
+    '''
+    Read the Pandora observations between mindate and maxdate for location
+    entry iloc and add empty entries for the GEOS-CF fields. Returns a
+    dictionary with the observations, the site name, latitude and longitude,
+    the location entry, the output file and its checkpoint journal, or None if
+    the site is to be skipped. If the journal of an interrupted run exists,
+    the run is resumed: years already completed are skipped and a CSV output
+    file is truncated to its size after the last completed year.
+    '''
+    basename = iloc.get('pandora_url').split('/')[-1]
+    ifile = "obs/"+basename
+    # use compressed file if there is no plain text file
+    for ext in PANDORA_COMPRESSION:
+        if not os.path.isfile(ifile) and os.path.isfile(ifile+ext):
+            ifile = ifile+ext
+    if not os.path.isfile(ifile):
+        print("obs file does not exist, skip: {}".format(ifile))
+        return None
+
+    # output file, partitioned output directory of site for parquet, or site
+    # key for sqlite
+    if args.format=='parquet':
+        ofile = "merged_parquet/site="+basename.replace(".txt","")
+    elif args.format=='sqlite':
+        ofile = basename.replace(".txt","")
+    else:
+        ofile = "merged_csv/"+basename.replace(".txt","+GEOSCF.csv")
+    jfile = _journal_file(args,ofile)
+    done = _read_journal(jfile)
+    if done is not None:
+        print("resuming interrupted run for {}, years completed: {}".format(ofile,done['years']))
+        if args.format=='csv':
+            _truncate_output(ofile,done['size'])
+    if args.format=='sqlite':
+        hasfile = _last_sqlite_date(args.db_file,ofile) is not None
+    elif args.format=='parquet':
+        hasfile = _last_parquet_date(ofile) is not None
+    else:
+        hasfile = os.path.exists(ofile)
+    # in incremental mode, only match observations newer than those in the file
+    if hasfile and args.incremental==1:
+        if args.format=='parquet':
+            last = _last_parquet_date(ofile)
+        elif args.format=='sqlite':
+            last = _last_sqlite_date(args.db_file,ofile)
+        else:
+            last = _last_merged_date(ofile)
+        if last is not None:
+            print("last observation in {}: {}".format(ofile,last))
+            mindate = max(mindate,last)
+    elif hasfile and args.skip==1 and done is None:
+        print("file exists, don't do anything: {}".format(ofile))
+        return None
+
+    extra = [c.strip() for c in args.extra_columns.split(',') if c.strip()!='']
+    # quality control is applied while reading
+    qc = _qc_settings(args.qval,args.min_l1hgt,args.max_l1hgt)
+    pand,lat,lon = _read_pandora(ifile,start=mindate,end=maxdate,extra=extra,qc=qc,cache=args.cache==1,
+                                 cache_dir=args.cache_dir,cache_max_mb=args.cache_max_mb)
+    if args.incremental==1 and hasfile:
+        pand = pand.loc[pand['date']>mindate,].reset_index(drop=True)
+        if pand.shape[0]==0:
+            print("no new observations for {}".format(ofile))
+            if done is not None:
+                os.remove(jfile)
+            return None
+    if done is None:
+        done = {'years':[], 'size':_output_size(args,ofile)}
+    else:
+        pand = pand.loc[~pand['date'].dt.year.isin(done['years']),].reset_index(drop=True)
+ 
+    # create empty entries for CF fields 
+    for v in CF_FIELDS:
+        pand[v] = np.nan
+
+    # add latitude and longitude to file
+    pand['lat'] = lat
+    pand['lon'] = lon
+
+    pand['year'] = pand['date'].dt.year
+    return {'ofile':ofile, 'pand':pand, 'name':iloc.get('site_name'), 'lat':lat, 'lon':lon, 'meta':iloc,
+            'journal':jfile, 'done':done}
+
+
+def _write_site(args,ofile,ipand):
+    '''
+    Write (or append) merged observations ipand to output file ofile. A new
+    file is written to a temporary file which then replaces ofile, so that
+    ofile is never left partially written. Appends go to ofile directly: the
+    size of ofile before the append is kept in the checkpoint journal, see
+    _truncate_output. The time stamp of the last observation written is kept
+    in a watermark file next to ofile, see _last_merged_date. For parquet and
+    sqlite output, see _write_site_parquet and _write_site_sqlite.
+    '''
+    if args.format=='parquet':
+        return _write_site_parquet(args,ofile,ipand)
+    if args.format=='sqlite':
+        return _write_site_sqlite(args,ofile,ipand)
+    hasfile = os.path.isfile(ofile)
+    # write new if file does not exist
+    if not hasfile:
+        wm  = 'w+'
+        hdr = True
+    else:
+        # append to existing file
+        if args.append==1 or args.incremental==1:
+            wm  = 'a'
+            hdr = False 
+        # overwrite old file
+        else:
+            wm  = 'w+'
+            hdr = True
+    # if appending, make sure order is correct. Columns must match those of
+    # the file (e.g. if --extra_columns changed between runs)
+    if wm=='a':
+        file_hdr = pd.read_csv(ofile,nrows=1)
+        dropped = [c for c in ipand.columns if c not in file_hdr.columns]
+        missing = [c for c in file_hdr.columns if c not in ipand.columns]
+        if len(dropped)>0:
+            print('Warning - columns not in {}, not written: {}'.format(ofile,','.join(dropped)))
+        if len(missing)>0:
+            print('Warning - columns missing, written as empty to {}: {}'.format(ofile,','.join(missing)))
+        ipand = ipand.reindex(columns=file_hdr.columns)
+    # now write to csv
+    if wm=='a':
+        ipand.to_csv(ofile,index=False,date_format="%Y-%m-%d %H:%M",mode=wm,header=hdr)  # float_format='%.4f'
+    else:
+        tmpfile = '{}.{}.tmp'.format(ofile,os.getpid())
+        ipand.to_csv(tmpfile,index=False,date_format="%Y-%m-%d %H:%M",mode=wm,header=hdr)
+        os.replace(tmpfile,ofile)
+    print("data written to {}".format(ofile))
+    tmpfile = '{}.json.{}.tmp'.format(ofile,os.getpid())
+    with open(tmpfile,'w') as f:
+        json.dump({'last_date':str(ipand['date'].max()), 'size':os.path.getsize(ofile)},f)
+    os.replace(tmpfile,ofile+'.json')
+    return
+
+
+def _journal_file(args,ofile):
+    '''
+    Return the checkpoint journal file of output ofile of a site.
+    '''
+    if args.format=='parquet':
+        # next to the partition directory of the site, which must only exist
+        # if observations were written (underscore: ignored by read_merged)
+        return os.path.join(os.path.dirname(ofile),'_{}.journal.json'.format(os.path.basename(ofile)))
+    if args.format=='sqlite':
+        return '{}.{}.journal.json'.format(args.db_file,ofile)
+    return ofile+'.journal.json'
+
+
+def _read_journal(jfile):
+    '''
+    Return the content of checkpoint journal jfile, i.e. the years completed
+    and the size of the output file after the last completed year, or None if
+    there is no journal.
+    '''
+    if not os.path.isfile(jfile):
+        return None
+    with open(jfile,'r') as f:
+        return json.load(f)
+
+
+def _write_journal(jfile,done):
+    '''
+    Atomically write the checkpoint journal jfile, see _read_journal.
+    '''
+    os.makedirs(os.path.dirname(jfile) or '.',exist_ok=True)
+    tmpfile = '{}.{}.tmp'.format(jfile,os.getpid())
+    with open(tmpfile,'w') as f:
+        json.dump(done,f)
+    os.replace(tmpfile,jfile)
+    return
+
+
+def _output_size(args,ofile):
+    '''
+    Return the size of CSV output file ofile, or None if it does not exist or
+    the output is not CSV.
+    '''
+    if args.format!='csv' or not os.path.isfile(ofile):
+        return None
+    return os.path.getsize(ofile)
+
+
+def _truncate_output(ofile,size):
+    '''
+    Restore CSV output file ofile to its size size recorded in the checkpoint
+    journal, removing observations written after the last completed year. If
+    size is None, ofile did not exist and is removed.
+    '''
+    if not os.path.isfile(ofile):
+        return
+    if size is None:
+        print("removing incomplete output {}".format(ofile))
+        os.remove(ofile)
+    elif os.path.getsize(ofile) > size:
+        print("truncating incomplete output {} to {} bytes".format(ofile,size))
+        with open(ofile,'r+b') as f:
+            f.truncate(size)
+    return
+
+
+def _last_merged_date(ofile,nbytes=65536):
+    '''
+    Return the time stamp of the last observation in merged output file ofile,
+    or None if the file has no observations. The exact time stamp is taken
+    from the watermark file written by _write_site if it is consistent with
+    ofile. Otherwise, it is read from the last line of ofile, where time stamps
+    are truncated to minutes; the end of that minute is returned.
+    '''
+    wfile = ofile+'.json'
+    if os.path.isfile(wfile):
+        with open(wfile,'r') as f:
+            watermark = json.load(f)
+        if watermark.get('size') == os.path.getsize(ofile):
+            return pd.Timestamp(watermark['last_date'])
+    with open(ofile,'rb') as f:
+        header = f.readline().decode().strip().split(',')
+        f.seek(0,os.SEEK_END)
+        f.seek(max(f.tell()-nbytes,0))
+        lines = [l for l in f.read().decode().splitlines() if l.strip()!='']
+    if len(lines)==0 or lines[-1].split(',')==header:
+        return None
+    last = pd.Timestamp(lines[-1].split(',')[header.index('date')])
+    return last + pd.Timedelta(minutes=1) - pd.Timedelta(microseconds=1)
+
+
+def _write_site_parquet(args,odir,ipand):
     '''
-    Read GEOS-CF fields and calculate matching quantities at provided location (lat,lon)
+    Write merged observations ipand of one year to the Parquet output of a
+    site. The output is partitioned by site (odir, named site=<name>) and year
+    (subdirectory year=<year>), so that all sites can be read at once with
+    pd.read_parquet('merged_parquet'). Floating point columns are stored as
+    float32. When appending, the observations are merged with those already
+    in the partition, replacing observations with the same time stamp. The
+    partition file is replaced atomically, and each process writes to its own
+    temporary file, so that sites can be written by concurrent processes.
     '''
-    # initialize values
-    sfcmr=np.nan; sfcconc=np.nan; l1col=np.nan; pbl=np.nan; sfcmr_pandora=np.nan
-    # read new file if needed. Round to hour to match up with GEOS-CF time stamps
-    idate = row.date.round('H')
-    templ = idate.strftime(args.cf_template)
+    ipand = ipand.astype({c:np.float32 for c in ipand.columns if ipand[c].dtype==np.float64})
+    for y,ydat in ipand.groupby(ipand['date'].dt.year):
+        ofile = os.path.join(odir,'year={}'.format(y),'part-0.parquet')
+        if os.path.isfile(ofile) and (args.append==1 or args.incremental==1):
+            ydat = pd.concat([pd.read_parquet(ofile),ydat],ignore_index=True)
+            ydat = ydat.drop_duplicates(subset='date',keep='last').sort_values('date',kind='stable')
+        os.makedirs(os.path.dirname(ofile),exist_ok=True)
+        # hidden temporary file, ignored when reading the partitioned dataset
+        tmpfile = os.path.join(os.path.dirname(ofile),'.part-0.parquet.{}.tmp'.format(os.getpid()))
+        ydat.to_parquet(tmpfile,index=False,compression='zstd')
+        os.replace(tmpfile,ofile)
+        print("data written to {}".format(ofile))
+    return
+
+
+def _write_site_metadata(odir,iloc,lat,lon):
+    '''
+    Write the location entry iloc of a site, together with the Pandora
+    location (lat,lon), to file _site.json in the Parquet output odir of the
+    site, if observations were written. Files starting with an underscore are
+    ignored when reading the partitioned dataset, see read_merged.
+    '''
+    if len(glob.glob(os.path.join(odir,'year=*','part-0.parquet')))==0:
+        return
+    meta = dict(iloc)
+    meta.update({'site':os.path.basename(odir).split('=',1)[1], 'pandora_lat':lat, 'pandora_lon':lon})
+    mfile = os.path.join(odir,'_site.json')
+    with open(mfile+'.{}.tmp'.format(os.getpid()),'w') as f:
+        json.dump(meta,f)
+    os.replace(mfile+'.{}.tmp'.format(os.getpid()),mfile)
+    return
+
+
+def read_merged(odir='merged_parquet',sites=None,columns=None,metadata=True):
+    '''
+    Read the merged observations of all sites, or of the sites (partition
+    names, e.g. Pandora140s1_WashingtonDC_L2_rnvh3p1-8) in sites, from the
+    Parquet output odir in a single call. If columns is given, only these
+    observation columns are read. Returns a data frame indexed by (site,date)
+    and sorted by it, with the site metadata written by _write_site_metadata
+    added as columns if metadata is True.
+    '''
+    filters = [('site','in',list(sites))] if sites is not None else None
+    if columns is not None:
+        columns = ['site','date']+[c for c in columns if c not in ['site','date']]
+    dat = pd.read_parquet(odir,columns=columns,filters=filters)
+    dat['site'] = dat['site'].astype(str)
+    if metadata:
+        meta = []
+        for mfile in glob.glob(os.path.join(odir,'site=*','_site.json')):
+            with open(mfile,'r') as f:
+                meta.append(json.load(f))
+        if len(meta)>0:
+            dat = dat.merge(pd.DataFrame(meta),on='site',how='left')
+    return dat.set_index(['site','date']).sort_index()
+
+
+def _last_parquet_date(odir):
+    '''
+    Return the time stamp of the last observation in the Parquet output odir
+    of a site (see _write_site_parquet), or None if there are no observations.
+    '''
+    ofiles = glob.glob(os.path.join(odir,'year=*','part-0.parquet'))
+    if len(ofiles)==0:
+        return None
+    ofile = max(ofiles,key=lambda f: int(os.path.basename(os.path.dirname(f)).split('=')[1]))
+    dates = pd.read_parquet(ofile,columns=['date'])['date']
+    return dates.max() if dates.shape[0]>0 else None
+
+
+def _connect_sqlite(dbfile):
+    '''
+    Open SQLite database dbfile, in write-ahead log mode so that readers (e.g.
+    dashboards) are not blocked by writers. Concurrent writers wait for each
+    other.
+    '''
+    os.makedirs(os.path.dirname(dbfile) or '.',exist_ok=True)
+    con = sqlite3.connect(dbfile,timeout=600)
+    con.execute('PRAGMA journal_mode=WAL')
+    return con
+
+
+def _write_site_sqlite(args,site,ipand):
+    '''
+    Write merged observations ipand of site (see _read_site) to table merged of
+    the SQLite database args.db_file. Rows are keyed by (site,date) and
+    upserted (see _sqlite_upsert), so that reprocessing updates observations
+    instead of duplicating them. Rows are inserted in batches of args.db_batch
+    rows, within a single transaction.
+    '''
+    cols = [c for c in ipand.columns if c!='date']
+    dates = ipand['date'].dt.strftime('%Y-%m-%d %H:%M:%S.%f').values
+    vals = ipand[cols].astype(object).where(ipand[cols].notna(),None).values.tolist()
+    sql = _sqlite_upsert('merged',['site','date'],cols)
+    with contextlib.closing(_connect_sqlite(args.db_file)) as con:
+        with con:
+            _create_sqlite_tables(con,ipand[cols].dtypes)
+            for k in range(0,len(vals),args.db_batch):
+                con.executemany(sql,[[site,d]+v for d,v in zip(dates[k:k+args.db_batch],vals[k:k+args.db_batch])])
+    print("data written to {} (site {})".format(args.db_file,site))
+    return
+
+
+def _sqlite_upsert(table,keys,cols):
+    '''
+    Return the SQL statement to insert a row with the key columns keys and the
+    columns cols into table, or to update cols of the row if the key exists.
+    Other columns of an existing row (e.g. extra columns written by an earlier
+    run) are kept, unlike with INSERT OR REPLACE.
+    '''
+    names = keys+cols
+    return 'INSERT INTO {} ({}) VALUES ({}) ON CONFLICT({}) DO UPDATE SET {}'.format(
+           table,','.join(['"{}"'.format(c) for c in names]),','.join(['?']*len(names)),','.join(keys),
+           ','.join(['"{0}"=excluded."{0}"'.format(c) for c in cols]))
+
+
+def _create_sqlite_tables(con,dtypes):
+    '''
+    Create the tables merged and sites of the SQLite output if they do not
+    exist yet, and add missing columns (with data types dtypes) to table
+    merged. Table merged is indexed by (site,date) and by date.
+    '''
+    con.execute('CREATE TABLE IF NOT EXISTS merged (site TEXT NOT NULL, date TEXT NOT NULL, PRIMARY KEY (site,date))')
+    con.execute('CREATE INDEX IF NOT EXISTS merged_date ON merged (date)')
+    con.execute('CREATE TABLE IF NOT EXISTS sites (site TEXT PRIMARY KEY, site_name TEXT, latitude REAL, longitude REAL, '
+                'country TEXT, start_date TEXT, pandora_url TEXT, pandora_lat REAL, pandora_lon REAL)')
+    existing = [r[1] for r in con.execute('PRAGMA table_info(merged)')]
+    for c,dtype in dtypes.items():
+        if c not in existing:
+            con.execute('ALTER TABLE merged ADD COLUMN "{}" {}'.format(c,'INTEGER' if dtype.kind in 'iub' else 'REAL'))
+    return
+
+
+def _write_site_sqlite_metadata(dbfile,site,iloc,lat,lon):
+    '''
+    Write the location entry iloc of site, together with the Pandora location
+    (lat,lon), to table sites of SQLite database dbfile.
+    '''
+    if not os.path.isfile(dbfile):
+        return
+    keys = ['site_name','latitude','longitude','country','start_date','pandora_url']
+    with contextlib.closing(_connect_sqlite(dbfile)) as con:
+        with con:
+            _create_sqlite_tables(con,{})
+            con.execute(_sqlite_upsert('sites',['site'],keys+['pandora_lat','pandora_lon']),
+                        [site]+[iloc.get(k) for k in keys]+[float(lat),float(lon)])
+    return
+
+
+def _last_sqlite_date(dbfile,site):
+    '''
+    Return the time stamp of the last observation of site in SQLite database
+    dbfile, or None if there are no observations of site.
+    '''
+    if not os.path.isfile(dbfile):
+        return None
+    with contextlib.closing(_connect_sqlite(dbfile)) as con:
+        try:
+            last = con.execute('SELECT MAX(date) FROM merged WHERE site=?',[site]).fetchone()[0]
+        except sqlite3.OperationalError:
+            return None
+    return pd.Timestamp(last) if last is not None else None
+
+
+def _match_cf(args,pands,locs,dsets,index,stage,stores=None):
+    '''
+    Read GEOS-CF fields and calculate matching quantities for the observations
+    in pands, a list of observation frames of the sites at locations locs
+    (list of lat,lon). The GEOS-CF hours are processed in chronological order
+    (time-outer, site-inner): each hourly file is opened once, through the
+    DatasetCache dsets, and the columns of all sites with observations in this
+    hour are extracted from it, or from the subsets staged by the StagingCache
+    stage. If mf_hours is set, the files of multiple hours are read at once
+    instead (see _read_cf_multifile), without dsets and stage. Observations
+    for which not all GEOS-CF files are listed in the CFFileIndex index are
+    skipped. If stores is given, the GEOS-CF columns are taken from these
+    column stores of the sites (see _read_cf_store) instead. The CF_FIELDS
+    entries of pands are updated in place.
+    '''
+    # GEOS-CF file times of each observation. Round to hour to match up with
+    # GEOS-CF time stamps. For pbl collection, use tavg collection. Hence no
+    # rounding of input date (hourly files, i.e. floor to hour).
+    obs = pd.concat([pd.DataFrame({'site':i,
+                                   'hour':ipand['date'].dt.round('h').values,
+                                   'phour':ipand['date'].dt.floor('h').values,
+                                   'l1hgt':ipand['pandora_no2_l1hgt'].values,
+                                   'sfcconc':ipand['pandora_no2_sfcconc'].values}) for i,ipand in enumerate(pands)],
+                    ignore_index=True)
+    obs['iobs'] = np.arange(obs.shape[0])
+    site = obs['site'].values
+    l1hgt = obs['l1hgt'].values
+    vals = np.full((obs.shape[0],len(CF_FIELDS)),np.nan)
+    # skip observations without GEOS-CF data, their CF fields remain undefined
+    if stores is None:
+        mask = _cf_available(args,obs,index)
+    else:
+        mask = _store_available(obs,stores)
+    if not np.all(mask):
+        missing = obs.loc[~mask,'hour']
+        print('Warning - GEOS-CF data not found for {} hours between {} and {}, skip {} observations'.format(
+              missing.nunique(),missing.min(),missing.max(),np.sum(~mask)))
+    obs = obs.loc[mask,]
+    # GEOS-CF profiles and profile index of each observation
+    profs = []
+    iprof = np.full(vals.shape[0],-1)
+    # GEOS-CF columns of each hour. Those of upcoming hours are read in the
+    # background
+    hours = list(obs.groupby('hour'))
+    if stores is not None:
+        columns = _prefetch(hours,lambda item: _read_store_hour(item[0],item[1],stores))
+    elif args.mf_hours > 0:
+        columns = _read_cf_multifile(args,hours,locs)
+    else:
+        columns = _prefetch(hours,lambda item: _read_cf_hour(args,item[0],item[1],locs,dsets,stage),args.prefetch)
+    for (hour,hobs),(colc,colm,colp) in columns:
+        # calculate the GEOS-CF profile once for all observations of a site
+        # that use the same files, and broadcast it to these observations
+        for (i,phour),gobs in hobs.groupby(['site','phour']):
+            prof = _cf_profile(colc[i],colm[i],colp[(phour,i)])
+            rows = gobs['iobs'].values
+            vals[rows,:] = _cf_quantities(prof,gobs['sfcconc'].values)
+            iprof[rows] = len(profs)
+            profs.append(prof)
+    # layer 1 partial columns of all observations at once
+    if len(profs)>0:
+        rows = np.where(iprof>=0)[0]
+        vals[rows,CF_FIELDS.index('cf_no2_l1col')] = _l1_columns(np.array([prof['zl'] for prof in profs]),
+                                                                np.array([prof['col'] for prof in profs]),
+                                                                l1hgt[rows],iprof[rows])
+    for i,ipand in enumerate(pands):
+        ivals = vals[site==i,:]
+        for j,v in enumerate(CF_FIELDS):
+            ipand[v] = ivals[:,j]
+    return
+
+
+def _cf_available(args,obs,index):
+    '''
+    Return a boolean mask of the observations obs (with GEOS-CF hours 'hour'
+    and pbl hours 'phour') for which the GEOS-CF chm, met and pbl files all
+    exist. File existence is looked up in the CFFileIndex index, i.e. only the
+    distinct hours are checked and no file is accessed.
+    '''
+    inst = [hour for hour in obs['hour'].unique()
+            if all([index.isfile(hour.strftime(args.cf_template).replace('<col>',c)) for c in ['chm','met']])]
+    pbl = [phour for phour in obs['phour'].unique() if index.isfile(phour.strftime(args.pbl_template))]
+    return obs['hour'].isin(inst).values & obs['phour'].isin(pbl).values
+
+
+def _store_available(obs,stores):
+    '''
+    Return a boolean mask of the observations obs for which the column stores
+    of their sites (see _read_cf_store) hold the chm and met columns of their
+    GEOS-CF hour and the pbl height of their pbl hour.
+    '''
+    mask = np.zeros(obs.shape[0],dtype=bool)
+    for i,store in enumerate(stores):
+        isite = obs['site'].values==i
+        if store is None or not np.any(isite):
+            continue
+        rows = store['rows'].get_indexer(obs.loc[isite,'hour'])
+        prows = store['rows'].get_indexer(obs.loc[isite,'phour'])
+        inst = ~np.isnan(store['NO2'][:,-1]) & ~np.isnan(store['PS'])
+        pbl = ~np.isnan(store['ZPBL'])
+        # rows outside the store (e.g. store not extracted up to the
+        # observations yet) are -1 and must not be used as index
+        ok = (rows>=0) & (prows>=0)
+        imask = np.zeros(ok.shape,dtype=bool)
+        imask[ok] = inst[rows[ok]] & pbl[prows[ok]]
+        mask[isite] = imask
+    return mask
+
+
+def _read_cf_hour(args,hour,hobs,locs,dsets,stage):
+    '''
+    Read the GEOS-CF chm, met and pbl columns needed for the observations hobs
+    of GEOS-CF hour hour, at the site locations locs. Columns are read through
+    the StagingCache stage, files are opened through the DatasetCache dsets.
+    Returns dictionaries of the chm and met columns by site and of the pbl
+    columns by (pbl hour,site).
+    '''
+    templ = hour.strftime(args.cf_template)
     # chm collection
     ifilec = templ.replace('<col>','chm')
-    readchm = True
-    if 'chm' in fnl:
-        if fnl['chm']==ifilec:
-            dsc = dsl['chm']
-            readchm = False
-    if readchm:
-        if not os.path.isfile(ifilec):
-           print('Warning - file not found: {}'.format(ifilec))
-           return sfcmr, sfcconc, l1col, pbl, sfcmr_pandora, fnl, dsl
-        print('reading {}'.format(ifilec))
-        dsc = xr.open_dataset(ifilec)
-        fnl['chm']=ifilec
-        dsl['chm']=dsc.copy()
+    isites = list(hobs['site'].unique())
+    colc = dict(zip(isites,stage.read(dsets,'chm',ifilec,[locs[i] for i in isites])))
     # met collection
     ifilem = templ.replace('<col>','met')
-    readmet = True
-    if 'met' in fnl:
-        if fnl['met']==ifilem:
-            dsm = dsl['met']
-            readmet = False
-    if readmet:
-        print('reading {}'.format(ifilem))
-        dsm = xr.open_dataset(ifilem)
-        fnl['met']=ifilem
-        dsl['met']=dsm.copy()
-    # for pbl collection, use tavg collection. Hence no rounding of input date
-    ifilep = row.date.strftime(args.pbl_template)
-    readpbl = True
-    if 'pbl' in fnl:
-        if fnl['pbl']==ifilep:
-            dsp = dsl['pbl']
-            readpbl = False
-    if readpbl:
-        print('reading {}'.format(ifilep))
-        dsp = xr.open_dataset(ifilep)
-        fnl['pbl'] = ifilep
-        dsl['pbl'] = dsp.copy()
+    colm = dict(zip(isites,stage.read(dsets,'met',ifilem,[locs[i] for i in isites])))
+    # pbl collection. Files are shared by two subsequent hours.
+    colp = {}
+    for phour,pobs in hobs.groupby('phour'):
+        jsites = list(pobs['site'].unique())
+        ifilep = phour.strftime(args.pbl_template)
+        cols = stage.read(dsets,'pbl',ifilep,[locs[i] for i in jsites])
+        colp.update({(phour,i):col for i,col in zip(jsites,cols)})
+    return colc, colm, colp
+
+
+def _read_cf_multifile(args,hours,locs):
+    '''
+    Iterate over hours, a list of (GEOS-CF hour, observations) as in
+    _read_cf_hour, yielding each item with its GEOS-CF columns. The hours are
+    read in batches of args.mf_hours hours (see _read_cf_batch), upcoming
+    batches in the background.
+    '''
+    batches = [hours[k:k+args.mf_hours] for k in range(0,len(hours),args.mf_hours)]
+    for batch,cols in _prefetch(batches,lambda batch: _read_cf_batch(args,batch,locs),args.prefetch):
+        for item,icols in zip(batch,cols):
+            yield item, icols
+    return
+
+
+def _read_cf_batch(args,batch,locs):
+    '''
+    Read the GEOS-CF columns needed for a batch of hours, a list of (GEOS-CF
+    hour, observations). The files of each collection are combined into one
+    lazy multi-file dataset, from which the columns of all (hour,site) pairs
+    are selected in a single vectorized pointwise indexing call, so that the
+    chunk reads are scheduled together by dask. Returns the chm, met and pbl
+    columns of each hour as returned by _read_cf_hour.
+    '''
+    hours = [hour for hour,hobs in batch]
+    phours = sorted(set([phour for hour,hobs in batch for phour in hobs['phour'].unique()]))
+    # (hour, site) pairs for the chm and met collections, (pbl hour, site) for pbl
+    points = [(hour,i) for hour,hobs in batch for i in hobs['site'].unique()]
+    ppoints = sorted(set([(phour,i) for hour,hobs in batch for phour,i in zip(hobs['phour'],hobs['site'])]))
+    templ = [hour.strftime(args.cf_template) for hour in hours]
+    colc = _read_cf_points([t.replace('<col>','chm') for t in templ],hours,CF_VARIABLES['chm'],points,locs)
+    colm = _read_cf_points([t.replace('<col>','met') for t in templ],hours,CF_VARIABLES['met'],points,locs)
+    colp = _read_cf_points([phour.strftime(args.pbl_template) for phour in phours],phours,CF_VARIABLES['pbl'],ppoints,locs)
+    cols = []
+    for hour,hobs in batch:
+        isites = hobs['site'].unique()
+        jpoints = set(zip(hobs['phour'],hobs['site']))
+        cols.append(({i:colc[(hour,i)] for i in isites},{i:colm[(hour,i)] for i in isites},
+                     {p:colp[p] for p in jpoints}))
+    return cols
+
+
+def _read_cf_points(files,times,varnames,points,locs):
+    '''
+    Read variables varnames from the GEOS-CF files of times at points, a list
+    of (time, site) pairs, with site locations locs. Returns a dictionary with
+    the columns (see _read_cf_columns) of each point. Files are opened
+    sequentially: opening netCDF files from several threads at once, while
+    batches are read in the background, can crash the netCDF library.
+    '''
+    for ifile in files:
+        print('reading {}'.format(ifile))
+    with xr.open_mfdataset(files,combine='nested',concat_dim='time',data_vars='minimal',coords='minimal',
+                           compat='override',parallel=False) as ds:
+        itime = {t:k for k,t in enumerate(times)}
+        idx = [_grid_indices(ds,*locs[i]) for t,i in points]
+        sel = {'time':xr.DataArray([itime[t] for t,i in points],dims='points'),
+               'lat':xr.DataArray([x['lat'] for x in idx],dims='points'),
+               'lon':xr.DataArray([x['lon'] for x in idx],dims='points')}
+        col = ds[varnames].isel(sel).compute()
+    return {p:{v:col[v].values[k] for v in varnames} for k,p in enumerate(points)}
+
+
+def _read_store_hour(hour,hobs,stores):
+    '''
+    Same as _read_cf_hour, but taking the GEOS-CF columns from the column
+    stores of the sites.
+    '''
+    colc = {}
+    colm = {}
+    colp = {}
+    for (i,phour),gobs in hobs.groupby(['site','phour']):
+        row = stores[i]['rows'].get_loc(hour)
+        colc[i] = {v:stores[i][v][row] for v in CF_VARIABLES['chm']}
+        colm[i] = {v:stores[i][v][row] for v in CF_VARIABLES['met']}
+        colp[(phour,i)] = {v:stores[i][v][stores[i]['rows'].get_loc(phour)] for v in CF_VARIABLES['pbl']}
+    return colc, colm, colp
+
+
+def _cf_store_file(store_dir,iloc):
+    '''
+    Return the column store file in directory store_dir of location iloc (an
+    entry of the locations json file), or None if the location has no site name
+    or coordinates. The file is keyed by site name and coordinates, so that all
+    instruments at the same site share one store file.
+    '''
+    if any(iloc.get(k) is None for k in ['site_name','latitude','longitude']):
+        return None
+    return os.path.join(store_dir,'{}_{:.4f}_{:.4f}.GEOS-CF.nc4'.format(iloc['site_name'],iloc['latitude'],iloc['longitude']))
+
+
+def _read_cf_store(ifile,lat,lon,start,end):
+    '''
+    Read the GEOS-CF columns between start and end from the column store file
+    ifile (see extract_cf_sites.py) of the site at location (lat,lon). Returns
+    a dictionary with the time index ('rows') and the arrays of all
+    CF_VARIABLES, with the pbl height of the hour starting at each time, or
+    None if there is no store file for the site.
+    '''
+    if ifile is None or not os.path.isfile(ifile):
+        print('Warning - column store file not found: {}'.format(ifile))
+        return None
+    print('reading {}'.format(ifile))
+    with xr.open_dataset(ifile) as ds:
+        if abs(ds.attrs['latitude']-lat)>0.01 or abs(ds.attrs['longitude']-lon)>0.01:
+            print('Warning - location of column store {} ({},{}) differs from Pandora location ({},{})'.format(
+                  ifile,ds.attrs['latitude'],ds.attrs['longitude'],lat,lon))
+        ds = ds.sel(time=slice(start-dt.timedelta(hours=1),end+dt.timedelta(hours=1))).load()
+    store = {v:ds[v].values for varnames in CF_VARIABLES.values() for v in varnames}
+    store['rows'] = pd.DatetimeIndex(ds['time'].values)
+    return store
+
+
+def _prefetch(items,func,depth=0):
+    '''
+    Iterate over items, yielding each item together with func(item). If depth
+    is positive, func is evaluated in a background thread for up to depth
+    items ahead of the item currently being processed, so that e.g. reading
+    files overlaps with processing the previous items. A single thread is used
+    so that func is never called concurrently.
+    '''
+    if depth <= 0:
+        for item in items:
+            yield item, func(item)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        queue = collections.deque()
+        for item in items:
+            queue.append((item,pool.submit(func,item)))
+            if len(queue) > depth:
+                item,future = queue.popleft()
+                yield item, future.result()
+        while len(queue) > 0:
+            item,future = queue.popleft()
+            yield item, future.result()
+    return
+
+
+def _cf_profile(colc,colm,colp):
+    '''
+    Calculate the hour-dependent GEOS-CF quantities at a site from the chm, met
+    and pbl columns colc, colm and colp. Returns a dictionary with the surface
+    mixing ratio and concentration, the boundary layer height, the quantities
+    needed to convert Pandora surface concentrations, and the layer heights
+    and NO2 partial columns ordered from the surface upwards.
+    '''
+    prof = {}
     # get pbl
-    pbl = dsp.sel(lon=lon,lat=lat,method='nearest')['ZPBL'].values[0] 
+    prof['pbl'] = colp['ZPBL'] 
     # surface NO2 mixing ratios in ppb and mol/m3
-    iconc = dsc.sel(lon=lon,lat=lat,method='nearest')['NO2'].values[0,-1]
-    prs = dsm.sel(lon=lon,lat=lat,method='nearest')['PS'].values[0]
-    temp = dsm.sel(lon=lon,lat=lat,method='nearest')['T'].values[0,-1]
-    sfcmr = iconc * 1.0e9
-    sfcconc = iconc * prs / ( 8.314 * temp )
-    # partial column in moles/m2
-    ihgt = row.pandora_no2_l1hgt * 1000.
-    delp = dsm.sel(lon=lon,lat=lat,method='nearest')['DELP'].values[0,::-1]
-    zl   = dsm.sel(lon=lon,lat=lat,method='nearest')['ZL'].values[0,::-1]
-    q    = dsm.sel(lon=lon,lat=lat,method='nearest')['Q'].values[0,::-1]
-    no2  = dsc.sel(lon=lon,lat=lat,method='nearest')['NO2'].values[0,::-1]
-    inML = True
-    iL = 0
-    l1col = 0.0
-    while inML:
-        # layer top height
-        toph = (zl[iL]+zl[iL+1])/2. 
-        if (toph>ihgt):
-            both = (zl[iL]+zl[iL-1])/2. if iL>0 else 0.0
-            frac = (ihgt-both) / (toph-both)
-        else:
-            frac = 1.0
-        l1col += no2[iL] * delp[iL] * (1.-q[iL]) * VV_TO_MOLEC * frac
-        iL += 1
-        if frac < 1.0: 
-            inML = False
-        if iL>=len(zl)+1:
-            print('Warning: Pandora layer height greater than entire atmosphere: {}'.format(ihgt))
-            inML: False
+    iconc = colc['NO2'][-1]
+    prof['prs'] = colm['PS']
+    prof['temp'] = colm['T'][-1]
+    prof['sfcmr'] = iconc * 1.0e9
+    prof['sfcconc'] = iconc * prof['prs'] / ( 8.314 * prof['temp'] )
+    # partial columns in moles/m2
+    delp = colm['DELP'][::-1]
+    q    = colm['Q'][::-1]
+    no2  = colc['NO2'][::-1]
+    prof['zl'] = colm['ZL'][::-1]
+    prof['q0'] = q[0]
+    prof['col'] = no2 * delp * (1.-q.astype(np.float64)) * VV_TO_MOLEC
+    return prof
+
+
+def _cf_quantities(prof,sfcconc_pandora):
+    '''
+    Calculate GEOS-CF quantities for Pandora observations with surface
+    concentrations sfcconc_pandora (mol/m3), all using the GEOS-CF profile prof
+    (see _cf_profile). Returns an array with the values of CF_FIELDS for each
+    observation. The layer 1 partial column is left undefined, see _l1_columns.
+    '''
+    vals = np.full((len(sfcconc_pandora),len(CF_FIELDS)),np.nan)
     # convert reported pandora surface concentration from mol/m3 to ppbv. Inverse of
-    # the GEOS-CF conversion above. Also dry out.
-    sfcmr_pandora = row.pandora_no2_sfcconc / prs * ( 8.314 * temp ) * 1.0e9 / (1.-q[0])
-    return sfcmr, sfcconc, l1col, pbl, sfcmr_pandora, fnl, dsl
+    # the GEOS-CF conversion. Also dry out.
+    vals[:,0] = sfcconc_pandora / prof['prs'] * ( 8.314 * prof['temp'] ) * 1.0e9 / (1.-prof['q0'])
+    vals[:,1] = prof['sfcmr']
+    vals[:,2] = prof['sfcconc']
+    vals[:,4] = prof['pbl']
+    return vals
+
+
+def _l1_columns(zl,col,l1hgt,iprof):
+    '''
+    Return the GEOS-CF NO2 partial columns (moles/m2) from the surface up to the
+    Pandora layer 1 heights l1hgt (km) of all observations at once. zl and col
+    are the stacked GEOS-CF layer heights (m) and layer NO2 amounts (moles/m2)
+    of all profiles, ordered from the surface upwards (nprof x nlev), and iprof
+    is the profile index of each observation. Layer edges are halfway between
+    the layer heights, with the surface at 0 and the top edge of the highest
+    layer extrapolated from its lower half. Layers below l1hgt are fully
+    included, the layer containing l1hgt proportionally to the fraction of its
+    depth below l1hgt. Heights above the model top get the total column.
+    '''
+    nprof,nlev = zl.shape
+    ihgt = l1hgt * 1000.
+    # layer top and bottom edges
+    mid = (zl[:,:-1]+zl[:,1:])/2.
+    top = np.concatenate([mid,2.*zl[:,-1:]-mid[:,-1:]],axis=1)
+    bot = np.concatenate([np.zeros((nprof,1)),mid],axis=1)
+    # column below each layer
+    cum = np.concatenate([np.zeros((nprof,1)),np.cumsum(col,axis=1)],axis=1)
+    # index of the layer containing ihgt, i.e. of the first layer with top above
+    # ihgt. All profiles are searched at once by shifting each by a multiple of
+    # the height range.
+    span = max(np.nanmax(top),np.nanmax(ihgt)) - min(np.nanmin(top),np.nanmin(ihgt)) + 1.
+    k = np.searchsorted((top+np.arange(nprof)[:,None]*span).ravel(),ihgt+iprof*span,side='right') - iprof*nlev
+    above = (k>=nlev)&~np.isnan(ihgt)
+    if np.any(above):
+        print('Warning: Pandora layer height greater than entire atmosphere for {} observations'.format(np.sum(above)))
+    k = np.minimum(k,nlev-1)
+    frac = (ihgt-bot[iprof,k]) / (top[iprof,k]-bot[iprof,k])
+    l1col = np.where(above,cum[iprof,nlev],cum[iprof,k]+col[iprof,k]*frac)
+    l1col[np.isnan(ihgt)] = np.nan
+    return l1col
+
+
+def _read_cf_columns(ds,varnames,locs):
+    '''
+    Read variables varnames of (lazily opened) GEOS-CF dataset ds at the grid
+    boxes nearest to the locations locs (list of lat,lon). Only the hyperslabs
+    of the columns are read from disk, without loading the global fields.
+    Returns a list with one dictionary per location, holding the values of
+    the (first) time slice as numpy arrays.
+    '''
+    cols = []
+    for lat,lon in locs:
+        col = ds[varnames].isel(_grid_indices(ds,lat,lon)).load()
+        cols.append({v:col[v].values[0] for v in varnames})
+    return cols
+
+
+class DatasetCache(object):
+    '''
+    Size-bounded least recently used cache of open GEOS-CF datasets, keyed by
+    collection and file path. Datasets evicted from the cache are closed.
+    '''
+    def __init__(self,maxsize=8):
+        self.maxsize = max(maxsize,1)
+        self.datasets = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,collection,ifile):
+        '''
+        Return the open dataset of file ifile of collection, opening it if needed.
+        '''
+        key = (collection,ifile)
+        if key in self.datasets:
+            self.hits += 1
+            self.datasets.move_to_end(key)
+            return self.datasets[key]
+        self.misses += 1
+        print('reading {}'.format(ifile))
+        self.datasets[key] = xr.open_dataset(ifile)
+        while len(self.datasets) > self.maxsize:
+            _,ds = self.datasets.popitem(last=False)
+            ds.close()
+        return self.datasets[key]
+
+    def close(self):
+        '''
+        Close all open datasets.
+        '''
+        for ds in self.datasets.values():
+            ds.close()
+        self.datasets.clear()
+        return
 
+    def stats(self):
+        '''
+        Return a summary of cache hits and misses.
+        '''
+        return 'GEOS-CF dataset cache: {} hits, {} misses'.format(self.hits,self.misses)
 
-def _read_pandora(ifile):
+
+class CFFileIndex(object):
+    '''
+    Index of the files available in the GEOS-CF archive, built from listings of
+    the archive directories. Each directory is listed once and the listing is
+    kept in memory. If ifile is given, the listings are also stored on disk and
+    reused by later runs as long as the modification time of the directory is
+    unchanged, so that only one stat call per directory is needed.
+    '''
+    def __init__(self,ifile=None):
+        self.ifile = ifile if ifile else None
+        self.listings = {}
+        self.checked = set()
+        self.modified = False
+        if self.ifile is not None and os.path.isfile(self.ifile):
+            try:
+                with open(self.ifile,'r') as f:
+                    self.listings = json.load(f)
+            except ValueError as e:
+                print('Warning - cannot read GEOS-CF file index {}: {}'.format(self.ifile,e))
+
+    def isfile(self,ifile):
+        '''
+        Check if file ifile exists according to the listing of its directory.
+        '''
+        idir,name = os.path.split(ifile)
+        if idir not in self.checked:
+            self._update(idir)
+        listing = self.listings[idir]
+        return listing['files'] is not None and name in listing['files']
+
+    def _update(self,idir):
+        '''
+        List directory idir, unless the listing on file is still current.
+        '''
+        self.checked.add(idir)
+        try:
+            mtime = os.stat(idir).st_mtime_ns
+        except OSError:
+            mtime = None
+        listing = self.listings.get(idir)
+        if listing is not None and listing['mtime'] == mtime and mtime is not None:
+            return
+        files = sorted(os.listdir(idir)) if mtime is not None else None
+        self.listings[idir] = {'mtime':mtime, 'files':files}
+        self.modified = True
+        return
+
+    def save(self):
+        '''
+        Write the directory listings to the index file, if any.
+        '''
+        if self.ifile is None or not self.modified:
+            return
+        os.makedirs(os.path.dirname(self.ifile) or '.',exist_ok=True)
+        # per-process temporary file, the index may be shared by concurrent runs
+        tmpfile = '{}.{}.tmp'.format(self.ifile,os.getpid())
+        with open(tmpfile,'w') as f:
+            json.dump(self.listings,f)
+        os.replace(tmpfile,self.ifile)
+        self.modified = False
+        print('GEOS-CF file index written to {}'.format(self.ifile))
+        return
+
+
+class StagingCache(object):
+    '''
+    Local staging cache of GEOS-CF subsets. If stage_dir is given, the needed
+    variables of a small window of +/- window grid boxes around each site are
+    copied from the GEOS-CF file to a small netCDF file in stage_dir (e.g. on a
+    node-local SSD) the first time they are needed, and read from there in
+    subsequent runs. Staged files are keyed by source file, its modification
+    time and the site location. If max_mb is positive, least recently used
+    staged files are evicted on close until the cache is below this size.
+    Without stage_dir, columns are read from the GEOS-CF files directly.
+    '''
+    def __init__(self,stage_dir=None,max_mb=0.,window=1):
+        self.stage_dir = stage_dir if stage_dir else None
+        self.max_mb = max_mb
+        self.window = max(window,0)
+        self.mtimes = {}
+        self.hits = 0
+        self.misses = 0
+        if self.stage_dir is not None:
+            os.makedirs(self.stage_dir,exist_ok=True)
+
+    def read(self,dsets,collection,ifile,locs):
+        '''
+        Return the columns of the CF_VARIABLES of collection in GEOS-CF file
+        ifile at locations locs, see _read_cf_columns. The file is only opened
+        (through the DatasetCache dsets) if some of the subsets are not staged.
+        '''
+        varnames = CF_VARIABLES[collection]
+        if self.stage_dir is None:
+            return _read_cf_columns(dsets.get(collection,ifile),varnames,locs)
+        if ifile not in self.mtimes:
+            self.mtimes[ifile] = os.stat(ifile).st_mtime_ns
+        cols = []
+        for lat,lon in locs:
+            sfile = self._staged_file(ifile,varnames,lat,lon)
+            if os.path.isfile(sfile):
+                self.hits += 1
+                # mark as recently used
+                os.utime(sfile)
+            else:
+                self.misses += 1
+                self._stage(dsets.get(collection,ifile),varnames,lat,lon,sfile)
+            with xr.open_dataset(sfile) as ds:
+                cols += _read_cf_columns(ds,varnames,[(lat,lon)])
+        return cols
+
+    def _staged_file(self,ifile,varnames,lat,lon):
+        '''
+        Return the staged file of the subset of ifile at location (lat,lon).
+        '''
+        key = '{}|{}|{}|{!r}|{!r}|{}'.format(ifile,self.mtimes[ifile],','.join(varnames),lat,lon,self.window)
+        sha = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(self.stage_dir,'{}.{}.nc4'.format(os.path.basename(ifile),sha))
+
+    def _stage(self,ds,varnames,lat,lon,sfile):
+        '''
+        Write the window around location (lat,lon) of variables varnames of
+        dataset ds to the staged file sfile. The window is clipped at the grid
+        edges so that the nearest grid box is always included.
+        '''
+        idx = _grid_indices(ds,lat,lon)
+        sel = {d:slice(max(idx[d]-self.window,0),idx[d]+self.window+1) for d in ['lat','lon']}
+        sub = ds[varnames].isel(sel).load()
+        # store uncompressed with native data types
+        for v in sub.variables:
+            sub[v].encoding = {}
+        # per-process temporary file, the staging directory may be shared
+        tmpfile = '{}.{}.tmp'.format(sfile,os.getpid())
+        sub.to_netcdf(tmpfile,format='NETCDF4')
+        os.replace(tmpfile,sfile)
+        return
+
+    def close(self):
+        '''
+        Evict least recently used staged files and report cache statistics.
+        '''
+        if self.stage_dir is None:
+            return
+        print('GEOS-CF staging cache: {} hits, {} misses'.format(self.hits,self.misses))
+        if self.max_mb > 0.:
+            _evict_cache(self.stage_dir,self.max_mb,'*.nc4')
+        return
+
+
+def _grid_indices(ds,lat,lon):
     '''
-    Read pandora observations (L2_rnvh3p1-8)
+    Return the indices of the grid box of dataset ds nearest to location
+    (lat,lon) as a dictionary that can be passed to isel. The lookup is the same
+    as for sel(method='nearest') but is done only once per grid definition and
+    location.
+    '''
+    grid = tuple([(ds.indexes[d].size,float(ds.indexes[d][0]),float(ds.indexes[d][-1])) for d in ['lat','lon']])
+    key = (grid,lat,lon)
+    if key not in _GRID_INDEX_CACHE:
+        _GRID_INDEX_CACHE[key] = {'lat':int(ds.indexes['lat'].get_indexer([lat],method='nearest')[0]),
+                                  'lon':int(ds.indexes['lon'].get_indexer([lon],method='nearest')[0])}
+    return _GRID_INDEX_CACHE[key]
+
+
+def _read_pandora(ifile,start=None,end=None,extra=None,qc=None,cache=False,cache_dir=None,cache_max_mb=0.):
+    '''
+    Read pandora observations (L2_rnvh3p1-8). The file is read in a single
+    streaming pass: the header block is consumed first, then the open file
+    handle is passed on to the observation parser. Compressed files (see
+    PANDORA_COMPRESSION) are decompressed on the fly. If start and/or end are
+    given, only observations within this (inclusive) time window are returned.
+    Besides the default columns, the Pandora columns listed in extra are read
+    (see PANDORA_COLUMNS). Observations failing the quality control settings qc
+    (see _qc_mask) are dropped while parsing. If cache is True, the full record
+    is read through the observation cache in cache_dir, see
+    _read_pandora_cached.
     '''
     print('Reading {}'.format(ifile))
-    dat = pd.read_csv(ifile,sep=',',skiprows=93,encoding="utf-8")
-    tmp = []
-    for l in range(dat.shape[0]):
-        iline = dat.iloc[l]
-        vals = iline[0].split(" ")
-        idate = dt.datetime.strptime(vals[0],"%Y%m%dT%H%M%S.%fz")
-        qval = int(vals[52])
-        sfcmr = float(vals[55])
-        l1hgt = float(vals[67])
-        l1col = float(vals[68])
-        irow = pd.DataFrame({"date":[idate],"pandora_no2_qval":[qval],"pandora_no2_sfcconc":[sfcmr],"pandora_no2_l1hgt":[l1hgt],"pandora_no2_l1col":[l1col]})
-        tmp.append(irow)
-    alldat = pd.concat(tmp)
-    # get latitude and longitude
-    f = open(ifile,'rb')
-    lat = None 
-    lon = None 
-    while lat is None or lon is None: 
-        line = str(f.readline())
-        if "Location latitude" in line:
-            lat = float(str(line.split(':')[1]).replace(" ","").replace("\\n","").replace("'",""))
-            print("location latitude: {}".format(lat))
-        if "Location longitude" in line:
-            lon = float(str(line.split(':')[1]).replace(" ","").replace("\\n","").replace("'",""))
-            print("location longitude: {}".format(lon))
+    if cache:
+        alldat,hdr = _read_pandora_cached(ifile,cache_dir,cache_max_mb,extra,qc)
+        alldat = _select_window(alldat,start,end)
+    else:
+        with _open_pandora(ifile) as f:
+            hdr = _read_pandora_header(f)
+            layout = _column_layout(hdr,extra)
+            # compressed files are streamed, the time window is applied afterwards
+            if _compression(ifile) is not None:
+                alldat = _select_window(_parse_pandora_block(f,layout,qc),start,end)
+            elif start is None and end is None:
+                alldat = _parse_pandora_block(f,layout,qc)
+            else:
+                alldat = _parse_pandora_window(f,hdr['offset'],layout,start,end,qc)
+    lat = hdr['lat']
+    lon = hdr['lon']
+    print("location latitude: {}".format(lat))
+    print("location longitude: {}".format(lon))
     return alldat,lat,lon
 
 
+def _compression(ifile):
+    '''
+    Return the compression suffix (one of PANDORA_COMPRESSION) of Pandora file
+    ifile, or None if the file is not compressed.
+    '''
+    ext = os.path.splitext(ifile)[1]
+    return ext if ext in PANDORA_COMPRESSION else None
+
+
+def _open_pandora(ifile):
+    '''
+    Open Pandora file ifile for binary reading. Compressed files (.gz, .xz,
+    .zst) are decompressed on the fly while reading.
+    '''
+    ext = _compression(ifile)
+    if ext == '.gz':
+        return gzip.open(ifile,'rb')
+    if ext == '.xz':
+        return lzma.open(ifile,'rb')
+    if ext == '.zst':
+        import zstandard
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(ifile,'rb'),closefd=True))
+    return open(ifile,'rb')
+
+
+def _read_pandora_header(f):
+    '''
+    Read the header of a Pandora file from the open (binary) file handle f.
+    The header consists of general file entries and the column descriptions,
+    each block terminated by a dashed separator line. On return, f is positioned
+    at the first observation. Returns a dictionary with the general entries
+    ('meta'), the column descriptions keyed by 0-based column index ('columns'),
+    the byte offset of the first observation ('offset') and the location
+    latitude and longitude ('lat', 'lon').
+    '''
+    hdr = {'meta':{}, 'columns':{}, 'lat':None, 'lon':None}
+    nsep = 0
+    icol = None
+    while nsep < 2:
+        line = f.readline()
+        if not line:
+            raise ValueError('end of file reached before end of Pandora header')
+        line = line.decode('utf-8',errors='replace').strip()
+        if line.startswith('---'):
+            nsep += 1
+            continue
+        key,_,val = line.partition(':')
+        # general file entries
+        if nsep == 0:
+            hdr['meta'][key.strip()] = val.strip()
+            if "Location latitude" in key:
+                hdr['lat'] = float(val)
+            if "Location longitude" in key:
+                hdr['lon'] = float(val)
+        # column descriptions, which may continue over multiple lines
+        elif key.startswith('Column '):
+            icol = int(key.split()[1])-1
+            hdr['columns'][icol] = val.strip()
+        elif icol is not None:
+            hdr['columns'][icol] += ' '+line
+    hdr['offset'] = f.tell() if f.seekable() else None
+    return hdr
+
+
+def _pandora_version(hdr):
+    '''
+    Return the processing version (e.g. rnvh3p1-8) of a Pandora file from the
+    file name entry of its header, or None if it cannot be determined.
+    '''
+    m = re.search(r'_L2_?([A-Za-z0-9]+p\d+-\d+)',hdr['meta'].get('File name',''))
+    return m.group(1) if m else None
+
+
+def _column_layout(hdr,extra=None):
+    '''
+    Return the 0-based column indices of the default Pandora columns plus the
+    columns listed in extra as a dictionary. Columns are identified from the
+    column descriptions in header hdr, falling back to the known layout of the
+    processing version. Resolved layouts are cached by processing version.
+    Requested extra columns that cannot be found are skipped with a warning.
+    '''
+    extra = [] if extra is None else extra
+    version = _pandora_version(hdr)
+    layout = _LAYOUT_CACHE.setdefault(version,{}) if version is not None else {}
+    for name in PANDORA_DEFAULT_COLUMNS+extra:
+        if name in layout:
+            continue
+        m = re.match(r'pandora_col(\d+)$',name)
+        if m:
+            if int(m.group(1))-1 in hdr['columns']:
+                layout[name] = int(m.group(1))-1
+            continue
+        if name not in PANDORA_COLUMNS:
+            continue
+        desc = PANDORA_COLUMNS[name].lower()
+        found = [i for i,v in sorted(hdr['columns'].items()) if v.lower().startswith(desc)]
+        default = PANDORA_LAYOUTS.get(version,{}).get(name)
+        if len(found)>0:
+            layout[name] = found[0]
+            if default is not None and default != found[0]:
+                print('Warning - {} found in column {}, expected {} for version {}'.format(name,found[0]+1,default+1,version))
+        elif default is not None:
+            layout[name] = default
+        elif name in PANDORA_DEFAULT_COLUMNS:
+            raise ValueError('cannot find Pandora column {} ({}) in header of version {}'.format(name,PANDORA_COLUMNS[name],version))
+    for name in extra:
+        if name not in layout:
+            print('Warning - Pandora column not found, skip: {}'.format(name))
+    return {name:layout[name] for name in PANDORA_DEFAULT_COLUMNS+extra if name in layout}
+
+
+def _parse_pandora_block(src,layout,qc=None):
+    '''
+    Parse a block of Pandora observation lines from src (path, file handle or
+    buffer) with the pandas C engine, in chunks of PANDORA_CHUNKSIZE lines.
+    Only the time stamp and the columns in layout (a dictionary of column name
+    and 0-based index) are tokenized. Observations rejected by the quality
+    control settings qc (see _qc_mask) are dropped from each chunk before the
+    time stamps are converted to datetime64 in bulk.
+    '''
+    usecols = [0]+list(layout.values())
+    try:
+        chunks = [dat.loc[_qc_mask(dat,layout,qc)] for dat in
+                  pd.read_csv(src,sep=' ',header=None,usecols=usecols,dtype={0:str},
+                              engine='c',encoding="utf-8",chunksize=PANDORA_CHUNKSIZE)]
+    except pd.errors.EmptyDataError:
+        chunks = []
+    if len(chunks)>0:
+        dat = pd.concat(chunks)
+    else:
+        dat = pd.DataFrame({i:np.array([],dtype=str if i==0 else float) for i in usecols})
+    alldat = pd.DataFrame({"date":pd.to_datetime(dat[0].values,format=PANDORA_DATE_FORMAT)})
+    for name,icol in layout.items():
+        alldat[name] = dat[icol].values
+    return alldat
+
+
+def _qc_mask(dat,layout,qc=None):
+    '''
+    Return a boolean mask of the observations in raw Pandora data dat (columns
+    named by 0-based column index, see layout) that pass the quality control
+    settings qc. qc is a dictionary with entries 'qval' (list of accepted
+    quality flags, or None for all) and 'l1hgt' (lower and upper limit of the
+    layer 1 height in km, both exclusive, or None for no limits).
+    '''
+    mask = np.ones(dat.shape[0],dtype=bool)
+    if qc is None:
+        return mask
+    if qc.get('qval') is not None:
+        mask &= dat[layout['pandora_no2_qval']].isin(qc['qval']).values
+    if qc.get('l1hgt') is not None:
+        hgt = dat[layout['pandora_no2_l1hgt']].values
+        mask &= (hgt>qc['l1hgt'][0])&(hgt<qc['l1hgt'][1])
+    return mask
+
+
+def _qc_settings(qval,min_l1hgt,max_l1hgt):
+    '''
+    Return the quality control settings (see _qc_mask) for the given accepted
+    quality flags qval and layer 1 height limits. qval is either a name in
+    PANDORA_QVAL_CLASSES or a comma-separated list of quality flags.
+    '''
+    if qval in PANDORA_QVAL_CLASSES:
+        qvals = PANDORA_QVAL_CLASSES[qval]
+    else:
+        qvals = [int(i) for i in qval.split(',')]
+    return {'qval':qvals, 'l1hgt':[min_l1hgt,max_l1hgt]}
+
+
+def _parse_pandora_window(f,offset,layout,start=None,end=None,qc=None):
+    '''
+    Parse the observations of the open (binary) Pandora file f that fall between
+    start and end (inclusive), with offset being the byte position of the first
+    observation. See _parse_pandora_block for layout and qc. Pandora records are
+    time-ordered, so the byte range of the window is located by bisection on
+    the leading time stamp of each line of the memory-mapped file, and only
+    this slice is handed to the parser.
+    '''
+    size = os.fstat(f.fileno()).st_size
+    with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        lo = offset
+        hi = size
+        if start is not None:
+            lo = _bisect_lines(mm,lo,hi,start.strftime(PANDORA_KEY_FORMAT).encode())
+        if end is not None:
+            hi = _bisect_lines(mm,lo,hi,end.strftime(PANDORA_KEY_FORMAT).encode(),right=True)
+        print('parsing bytes {} to {} of {}'.format(lo,hi,size))
+        alldat = _parse_pandora_block(io.BytesIO(mm[lo:hi]),layout,qc)
+    # bisection works on full seconds, apply exact limits
+    return _select_window(alldat,start,end)
+
+
+def _select_window(alldat,start=None,end=None):
+    '''
+    Return the observations between start and end (inclusive).
+    '''
+    if start is not None:
+        alldat = alldat.loc[alldat['date']>=start,]
+    if end is not None:
+        alldat = alldat.loc[alldat['date']<=end,]
+    return alldat.reset_index(drop=True)
+
+
+def _bisect_lines(mm,lo,hi,key,right=False):
+    '''
+    Return the byte offset of the first line in mm[lo:hi] whose leading time
+    stamp is not less than key (greater than key if right is True). lo must be
+    the start of a line. Lines are assumed to be sorted by time.
+    '''
+    nkey = len(key)
+    while lo < hi:
+        mid = (lo+hi)//2
+        # start of the line containing mid
+        start = max(mm.rfind(b'\n',lo,mid)+1,lo)
+        ikey = mm[start:start+nkey]
+        if ikey < key or (right and ikey == key):
+            end = mm.find(b'\n',start,hi)
+            lo = hi if end < 0 else end+1
+        else:
+            hi = start
+    return lo
+
+
+def _cache_files(ifile,cache_dir=None):
+    '''
+    Return the observation cache file and its metadata file for Pandora file
+    ifile. By default, the cache is stored next to the Pandora file.
+    '''
+    cdir = cache_dir if cache_dir is not None else os.path.dirname(ifile)
+    cfile = os.path.join(cdir,os.path.basename(ifile)+'.parquet')
+    return cfile, cfile+'.json'
+
+
+def _file_signature(ifile,nbytes=65536):
+    '''
+    Return a signature of file ifile, consisting of its size, modification time
+    and a SHA1 hash of the first and last nbytes bytes.
+    '''
+    st = os.stat(ifile)
+    sha = hashlib.sha1()
+    with open(ifile,'rb') as f:
+        sha.update(f.read(nbytes))
+        f.seek(max(st.st_size-nbytes,0))
+        sha.update(f.read(nbytes))
+    return {'size':st.st_size, 'mtime':st.st_mtime_ns, 'sha1':sha.hexdigest()}
+
+
+def _read_pandora_cached(ifile,cache_dir=None,max_mb=0.,extra=None,qc=None):
+    '''
+    Read the full record of Pandora file ifile through the observation cache.
+    The cached observations are used as is if size, modification time and hash
+    of the Pandora file match those recorded in the cache metadata. Pandora
+    files are append-only, so if the observations previously consumed from an
+    uncompressed file are unchanged (its header may have been rewritten), only
+    the appended tail is parsed and added to the cached observations.
+    Otherwise the file is parsed from scratch. The cache entry is also renewed
+    if it lacks any of the extra columns requested or if it was created with
+    other quality control settings. Returns the observations and the file
+    header.
+    '''
+    extra = [] if extra is None else extra
+    cfile,mfile = _cache_files(ifile,cache_dir)
+    meta = None
+    if os.path.isfile(cfile) and os.path.isfile(mfile):
+        with open(mfile,'r') as f:
+            meta = json.load(f)
+        meta['header']['columns'] = {int(k):v for k,v in meta['header']['columns'].items()}
+        # keep previously cached columns when adding new ones
+        cached = meta.get('extra',[])
+        if not set(extra) <= set(cached):
+            print('cache lacks requested columns: {}'.format(cfile))
+            extra = cached+[c for c in extra if c not in cached]
+            meta = None
+        elif meta.get('qc') != qc:
+            print('cache has different quality control settings: {}'.format(cfile))
+            meta = None
+    requested = ['date']+PANDORA_DEFAULT_COLUMNS+extra
+    signature = _file_signature(ifile)
+    if meta is not None and meta['signature'] == signature:
+        alldat = _read_parquet(cfile)
+        if alldat is not None:
+            print('reading cached observations from {}'.format(cfile))
+            # mark as recently used
+            os.utime(cfile)
+            return alldat[[c for c in alldat.columns if c in requested]], meta['header']
+    if _compression(ifile) is not None:
+        with _open_pandora(ifile) as f:
+            hdr = _read_pandora_header(f)
+            alldat = _parse_pandora_block(f,_column_layout(hdr,extra),qc)
+        end = None
+        prefix = None
+    else:
+        alldat,hdr,extra,end,prefix = _parse_pandora_tail(ifile,cfile,meta,extra,qc)
+    meta = {'source':os.path.abspath(ifile), 'signature':signature, 'header':hdr, 'extra':extra, 'qc':qc,
+            'offset':end, 'prefix_sha1':prefix,
+            'last_date':str(alldat['date'].values[-1]) if alldat.shape[0]>0 else None}
+    _write_pandora_cache(cfile,mfile,alldat,meta,max_mb)
+    return alldat[[c for c in alldat.columns if c in requested]], hdr
+
+
+def _parse_pandora_tail(ifile,cfile,meta,extra=None,qc=None):
+    '''
+    Parse the uncompressed Pandora file ifile up to its last complete line.
+    If the file still contains the observations consumed when the cache entry
+    described by meta was created, only the appended tail is parsed and added
+    to the observations in cache file cfile. Returns the observations, the file
+    header, the extra columns read, the byte offset consumed and the hash of
+    the consumed observations (see _prefix_hash).
+    '''
+    with open(ifile,'rb') as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        end = mm.rfind(b'\n')+1
+        # the header is read from the file, as it may have been rewritten
+        hdr = _read_pandora_header(f)
+        alldat = None
+        start = None if meta is None else _consumed_offset(mm,hdr,meta)
+        if start is not None:
+            alldat = _read_parquet(cfile)
+        if alldat is not None:
+            extra = meta.get('extra',[])
+            print('parsing {} appended bytes of {}'.format(end-start,ifile))
+            tail = _parse_pandora_block(io.BytesIO(mm[start:end]),_column_layout(hdr,extra),qc)
+            if tail.shape[0]>0 and alldat.shape[0]>0 and tail['date'].values[0]<alldat['date'].values[-1]:
+                print('Warning - appended observations are out of order, parse full file')
+                alldat = None
+            elif tail.shape[0]>0:
+                alldat = pd.concat([alldat,tail],ignore_index=True)
+        if alldat is None:
+            alldat = _parse_pandora_block(io.BytesIO(mm[hdr['offset']:end]),_column_layout(hdr,extra),qc)
+        prefix = _prefix_hash(mm,hdr['offset'],end)
+    return alldat,hdr,extra,end,prefix
+
+
+def _read_parquet(cfile):
+    '''
+    Read observations from the Parquet cache file cfile. Returns None if the
+    file cannot be read.
+    '''
+    try:
+        return pd.read_parquet(cfile)
+    except Exception as e:
+        print('Warning - cannot read observation cache {}: {}'.format(cfile,e))
+        return None
+
+
+def _prefix_hash(mm,start,end,nbytes=65536):
+    '''
+    Return a SHA1 hash of the first and last nbytes bytes of mm[start:end],
+    the observations consumed from a Pandora file. The header is not included,
+    as it is rewritten when observations are appended.
+    '''
+    sha = hashlib.sha1()
+    sha.update(mm[start:min(start+nbytes,end)])
+    sha.update(mm[max(end-nbytes,start):end])
+    return sha.hexdigest()
+
+
+def _consumed_offset(mm,hdr,meta):
+    '''
+    Return the byte offset up to which the memory-mapped Pandora file mm with
+    header hdr was consumed when the cache entry described by meta was created,
+    or None if the observations consumed have changed. The offset is relative
+    to the start of the observations, as the header may have changed in length.
+    '''
+    offset = meta.get('offset')
+    if offset is None or hdr['columns'] != meta['header']['columns']:
+        return None
+    end = hdr['offset'] + offset - meta['header']['offset']
+    if mm.size() < end:
+        return None
+    if _prefix_hash(mm,hdr['offset'],end) != meta.get('prefix_sha1'):
+        return None
+    return end
+
+
+def _write_pandora_cache(cfile,mfile,alldat,meta,max_mb=0.):
+    '''
+    Write the parsed observations to the Parquet cache file cfile and the
+    corresponding metadata (file signature, header, consumed byte offset and
+    last time stamp) to mfile. If max_mb is positive, least recently used cache
+    entries are evicted until the cache size is below this limit.
+    '''
+    os.makedirs(os.path.dirname(cfile) or '.',exist_ok=True)
+    # per-process temporary files, the cache may be shared by concurrent runs
+    ctmp = '{}.{}.tmp'.format(cfile,os.getpid())
+    mtmp = '{}.{}.tmp'.format(mfile,os.getpid())
+    try:
+        alldat.to_parquet(ctmp,index=False)
+    except ImportError as e:
+        print('Warning - cannot write observation cache: {}'.format(e))
+        return
+    os.replace(ctmp,cfile)
+    with open(mtmp,'w') as f:
+        json.dump(meta,f)
+    os.replace(mtmp,mfile)
+    print('observations cached in {}'.format(cfile))
+    if max_mb > 0.:
+        _evict_cache(os.path.dirname(cfile),max_mb,'*.parquet',keep=cfile)
+    return
+
+
+def _evict_cache(cdir,max_mb,pattern,keep=None):
+    '''
+    Remove least recently used entries (files matching pattern, together with
+    their .json metadata file if any) from the cache in cdir until its total
+    size is below max_mb megabytes. The entry keep is never removed.
+    '''
+    entries = []
+    for ifile in glob.glob(os.path.join(cdir,pattern)):
+        st = os.stat(ifile)
+        size = st.st_size + (os.path.getsize(ifile+'.json') if os.path.isfile(ifile+'.json') else 0)
+        entries.append((st.st_mtime,size,ifile))
+    total = sum([e[1] for e in entries])
+    for _,size,ifile in sorted(entries):
+        if total <= max_mb*1.0e6:
+            break
+        if ifile == keep:
+            continue
+        print('evicting from cache: {}'.format(ifile))
+        for jfile in [ifile,ifile+'.json']:
+            if os.path.isfile(jfile):
+                os.remove(jfile)
+        total -= size
+    return
+
+
 def parse_args():
     p = argparse.ArgumentParser(description='Undef certain variables')
     p.add_argument('-l', '--locations',type=str,help='locations',default="PANDORA_Locations.json")
-    p.add_argument('-n', '--nsite',type=int,help='location index in json list',default=0)
+    p.add_argument('-n', '--nsite',type=int,help='location index in json list, -1 for all sites',default=0)
     #p.add_argument('-i', '--ifile',type=str,help='input pandora file',default=None)
     p.add_argument('-c', '--cf_template',type=str,help='GEOS-CF file template',default="/discover/nobackup/projects/gmao/geos_cf/pub/GEOS-CF_NRT/ana/Y%Y/M%m/D%d/GEOS-CF.v01.rpl.<col>_inst_1hr_g1440x721_v72.%Y%m%d_%H00z.nc4")
     p.add_argument('-p', '--pbl_template',type=str,help='GEOS-CF pbl file template',default="/discover/nobackup/projects/gmao/geos_cf/pub/GEOS-CF_NRT/ana/Y%Y/M%m/D%d/GEOS-CF.v01.rpl.met_tavg_1hr_g1440x721_x1.%Y%m%d_%H30z.nc4")
     p.add_argument('-a', '--append',type=int,help='append to file if exists?',default=1)
     p.add_argument('-m', '--mindate',type=str,help='minimum date (%Y-%m-%d)',default="2020-01-01")
+    p.add_argument('-f', '--format',type=str,help='output format: csv (merged_csv/), parquet partitioned by site and year (merged_parquet/) or sqlite (--db_file)',default='csv',choices=['csv','parquet','sqlite'])
+    p.add_argument('--db_file',type=str,help='SQLite database for sqlite output',default="merged_pandora_cf.sqlite")
+    p.add_argument('--db_batch',type=int,help='number of rows inserted at once into the SQLite database',default=10000)
     p.add_argument('-s', '--skip',type=int,help='skip if output file already exists',default=1)
+    p.add_argument('--incremental',type=int,help='only add observations newer than those in existing output file?',default=0)
+    p.add_argument('--prefetch',type=int,help='number of GEOS-CF hours read ahead in the background, 0 to disable',default=2)
+    p.add_argument('--cf_index',type=str,help='file to store the index of available GEOS-CF files, empty to disable',default="GEOS-CF_index.json")
+    p.add_argument('--cf_store',type=str,help='read GEOS-CF columns from this column store directory (see extract_cf_sites.py)',default=None)
+    p.add_argument('--stage_dir',type=str,help='local directory to stage GEOS-CF subsets around the sites in, e.g. on a node-local SSD',default=None)
+    p.add_argument('--stage_max_mb',type=float,help='maximum size of staging cache in MB, 0 for no limit',default=0.)
+    p.add_argument('--stage_window',type=int,help='half width of the staged GEOS-CF window in grid boxes',default=1)
+    p.add_argument('--mf_hours',type=int,help='number of GEOS-CF hours read at once as one multi-file dataset, 0 to read hour by hour. --stage_dir and --max_open_files do not apply to multi-file datasets',default=0)
+    p.add_argument('--max_open_files',type=int,help='maximum number of GEOS-CF files kept open',default=8)
+    p.add_argument('-e', '--extra_columns',type=str,help='comma-separated list of additional Pandora columns to read, see PANDORA_COLUMNS',default="")
+    p.add_argument('-q', '--qval',type=str,help='accepted Pandora quality flags: all, high, medium or comma-separated list',default="all")
+    p.add_argument('--min_l1hgt',type=float,help='minimum Pandora layer 1 height in km (exclusive)',default=0.)
+    p.add_argument('--max_l1hgt',type=float,help='maximum Pandora layer 1 height in km (exclusive)',default=15.)
+    p.add_argument('--cache',type=int,help='cache parsed observations (parquet)?',default=1)
+    p.add_argument('--cache_dir',type=str,help='observation cache directory (default: next to obs file)',default=None)
+    p.add_argument('--cache_max_mb',type=float,help='maximum size of observation cache in MB, 0 for no limit',default=0.)
     return p.parse_args()
 
  